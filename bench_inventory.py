@@ -0,0 +1,133 @@
+# ----------------------------------------------------
+# Benchmark: inventory snapshot vs per-request SQLite queries
+# ----------------------------------------------------
+#
+#     python bench_inventory.py --items 10000 --lookups 100000
+#
+# Builds a throwaway single-warehouse database (schema.sql plus
+# shard_schema.sql in one file), then times the stock/price
+# lookup the routes used to do (open connection, SELECT, close) against
+# InventorySnapshot.lookup(), and reports the memory each approach adds to
+# a worker process.
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from inventory_snapshot import InventorySnapshot
+from warehouses import init_shard
+
+
+def rss_kb():
+    # (private, file-backed) resident memory of this process in kB
+    fields = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()[0] if value.split() else "0"
+    return int(fields.get("RssAnon", 0)), int(fields.get("RssFile", 0))
+
+
+def build_db(path, n_items):
+    conn = sqlite3.connect(path)
+    with open("schema.sql") as f:
+        conn.executescript(f.read())
+    init_shard(conn, 1)
+    conn.execute("INSERT INTO Categories (c_name) VALUES ('bench')")
+    conn.executemany(
+        "INSERT INTO Items (name, price_per_unit, c_id) VALUES (?, ?, 1)",
+        [("item%d" % i, random.randint(1, 50)) for i in range(n_items)],
+    )
+    conn.executemany(
+        "INSERT INTO Stock (item_id, weight) VALUES (?, ?)",
+        [(i + 1, random.randint(0, 100)) for i in range(n_items)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "bench.db")
+    build_db(db_path, args.items)
+    ids = [random.randint(1, args.items) for _ in range(args.lookups)]
+
+    def connect():
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def load_rows(item_ids):
+        conn = connect()
+        query = (
+            "SELECT Items.id, COALESCE(Stock.weight, 0), price_per_unit, c_id"
+            " FROM Items LEFT JOIN Stock ON Stock.item_id = Items.id"
+        )
+        if item_ids is None:
+            rows = conn.execute(query).fetchall()
+        else:
+            rows = conn.execute(
+                query + " WHERE Items.id IN ({})".format(",".join("?" * len(item_ids))),
+                item_ids,
+            ).fetchall()
+        conn.close()
+        return rows
+
+    # --- per-request query, as get_item() does it ---
+    anon0, file0 = rss_kb()
+    start = time.perf_counter()
+    for item_id in ids:
+        conn = connect()
+        row = conn.execute(
+            "SELECT Items.*, Stock.weight FROM Items"
+            " LEFT JOIN Stock ON Stock.item_id = Items.id WHERE Items.id = ?",
+            (item_id,),
+        ).fetchone()
+        stock, price = row["weight"], row["price_per_unit"]
+        conn.close()
+    query_us = (time.perf_counter() - start) / len(ids) * 1e6
+    anon1, file1 = rss_kb()
+
+    # --- shared snapshot ---
+    snapshot = InventorySnapshot(load_rows, os.path.join(workdir, "inventory.bin"))
+    build_start = time.perf_counter()
+    snapshot.refresh()
+    build_ms = (time.perf_counter() - build_start) * 1000
+    anon2, file2 = rss_kb()
+    start = time.perf_counter()
+    for item_id in ids:
+        entry = snapshot.lookup(item_id)
+        stock, price = entry.stock, entry.price
+    snapshot_us = (time.perf_counter() - start) / len(ids) * 1e6
+    anon3, file3 = rss_kb()
+
+    size_kb = os.path.getsize(snapshot.path) / 1024
+    print("items={} lookups={}".format(args.items, args.lookups))
+    print("per-request query : {:8.2f} us/lookup".format(query_us))
+    print(
+        "snapshot lookup   : {:8.2f} us/lookup  ({:.0f}x faster)".format(
+            snapshot_us, query_us / snapshot_us
+        )
+    )
+    print("snapshot build    : {:8.2f} ms (once per worker start)".format(build_ms))
+    print("memory (RSS growth per worker):")
+    print("  per-request queries : +{} kB private".format(anon1 - anon0))
+    print("  snapshot build      : +{} kB private (heap reused afterwards)".format(anon2 - anon1))
+    print(
+        "  snapshot lookups    : +{} kB private, +{} kB shared file pages "
+        "({:.0f} kB file, one copy per node)".format(
+            anon3 - anon2, file3 - file1, size_kb
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# ----------------------------------------------------
+# Benchmark: bulk vs single-order fulfillment
+# ----------------------------------------------------
+#
+#     python bench_orders.py --orders 500
+#
+# Builds a throwaway single-warehouse database (schema.sql plus
+# shard_schema.sql) in a temp directory, then
+# drives the real routes through Flask's test client: one request per order
+# for /<id>/collected and /<id>/delete_order, against one request per batch
+# for /orders/bulk_collect and /orders/bulk_cancel.
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from warehouses import init_shard
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_db(n_orders):
+    conn = sqlite3.connect("database.db")
+    with open(os.path.join(HERE, "schema.sql")) as f:
+        conn.executescript(f.read())
+    init_shard(conn, 1, os.path.join(HERE, "shard_schema.sql"))
+    conn.execute("INSERT INTO Admin (a_id, username, password) VALUES (1, 'admin', 'x')")
+    conn.execute("INSERT INTO User (u_id, u_username, u_password) VALUES (2, 'shopper', 'x')")
+    conn.execute("INSERT INTO Categories (c_name) VALUES ('bench')")
+    conn.executemany(
+        "INSERT INTO Items (name, price_per_unit, c_id) VALUES (?, 3, 1)",
+        [("item%d" % i,) for i in range(20)],
+    )
+    conn.executemany(
+        "INSERT INTO Stock (item_id, weight) VALUES (?, 1000)",
+        [(i + 1,) for i in range(20)],
+    )
+    conn.executemany(
+        "INSERT INTO Orders (u_id, item_id, quantity, price) VALUES (2, ?, 1, 3)",
+        [(i % 20 + 1,) for i in range(n_orders)],
+    )
+    conn.commit()
+    conn.execute("PRAGMA journal_mode = WAL")  # as init_db.py
+    conn.close()
+
+
+def order_ids():
+    conn = sqlite3.connect("database.db")
+    ids = [row[0] for row in conn.execute("SELECT order_id FROM Orders")]
+    conn.close()
+    return ids
+
+
+def timed(label, n_orders, run):
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:8.0f} orders/s  ({:.3f}s)".format(label, n_orders / elapsed, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=500)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    os.environ["INVENTORY_SNAPSHOT_FILE"] = os.path.join(workdir, "inventory.bin")
+    os.environ["RATE_LIMIT_FILE"] = os.path.join(workdir, "ratelimit.bin")
+    import app as webapp
+
+    client = webapp.app.test_client()
+    with client.session_transaction() as sess:
+        sess["_user_id"] = "1"
+        sess["_fresh"] = True
+
+    print("orders per run: {}".format(args.orders))
+    for action, single_route, bulk_route in (
+        ("collect", "/{}/collected", "/orders/bulk_collect"),
+        ("cancel", "/{}/delete_order", "/orders/bulk_cancel"),
+    ):
+        build_db(args.orders)
+        ids = order_ids()
+        timed(
+            "single {} (1 req/order)".format(action),
+            len(ids),
+            lambda: [client.post(single_route.format(i)) for i in ids],
+        )
+
+        build_db(args.orders)
+        ids = order_ids()
+        timed(
+            "bulk {} (1 request)".format(action),
+            len(ids),
+            lambda: client.post(bulk_route, data={"order_ids": ids}),
+        )
+        assert not order_ids(), "bulk {} left orders behind".format(action)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# ----------------------------------------------------
+# Benchmark: order-placement throughput vs number of warehouse shards
+# ----------------------------------------------------
+#
+#     python bench_warehouses.py --writers 4 --orders 300 --shards 1 2 4
+#
+# For each shard count, builds a throwaway catalog (database.db) plus that
+# many shard files (WAL, as init_db.py) in a temp directory and starts
+# --writers processes. Each writer imports the app with WAREHOUSES pointing
+# at those files and books --orders one-item checkouts through the same
+# calls the Stripe webhook makes: warehouses.pick_warehouse() reads the
+# item's stock in every shard, then warehouses.fan_out() runs place_orders()
+# in the chosen shard's transaction. Items are spread evenly over the shards.
+# Reports total committed orders per second.
+#
+# Separate shards only add throughput when their writers can run on
+# separate cores; on a single core the extra per-shard stock reads make
+# more shards slower. Note the cpu count printed with the results.
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from warehouses import init_shard
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+N_ITEMS = 64
+
+
+def build(workdir, n_shards):
+    conn = sqlite3.connect(os.path.join(workdir, "database.db"))
+    with open(os.path.join(HERE, "schema.sql")) as f:
+        conn.executescript(f.read())
+    conn.execute("INSERT INTO User (u_id, u_username, u_password) VALUES (2, 'shopper', 'x')")
+    conn.execute("INSERT INTO Categories (c_name) VALUES ('bench')")
+    conn.executemany(
+        "INSERT INTO Items (name, price_per_unit, c_id) VALUES (?, 3, 1)",
+        [("item%d" % i,) for i in range(N_ITEMS)],
+    )
+    conn.commit()
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+    shards = {}
+    for w_id in range(1, n_shards + 1):
+        path = os.path.join(workdir, "warehouse_{}.db".format(w_id))
+        conn = sqlite3.connect(path)
+        init_shard(conn, w_id, os.path.join(HERE, "shard_schema.sql"))
+        # Item i is stocked only in warehouse (i % n_shards) + 1
+        conn.executemany(
+            "INSERT INTO Stock (item_id, weight) VALUES (?, 1000000)",
+            [(i,) for i in range(1, N_ITEMS + 1) if (i % n_shards) + 1 == w_id],
+        )
+        conn.commit()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.close()
+        shards[w_id] = path
+    return shards
+
+
+def writer(workdir, shards, n_orders, seed, start, results):
+    os.chdir(workdir)
+    os.environ["WAREHOUSES"] = ",".join(
+        "{}={}".format(w_id, path) for w_id, path in shards.items()
+    )
+    os.environ["INVENTORY_SNAPSHOT_FILE"] = os.path.join(workdir, "inventory.bin")
+    os.environ["RATE_LIMIT_FILE"] = os.path.join(workdir, "ratelimit.bin")
+    import app as webapp
+
+    rng = random.Random(seed)
+    failed = 0
+    start.wait()
+    for n in range(n_orders):
+        item_id = rng.randint(1, N_ITEMS)
+        checkout_id = "bench-{}-{}".format(seed, n)
+        w_id = webapp.warehouses.pick_warehouse(item_id, 1)
+        outcome = webapp.warehouses.fan_out(
+            lambda conn, w_id: webapp.place_orders(
+                conn, 2, checkout_id, [(item_id, 1)]
+            ),
+            [w_id],
+        )
+        booked, _ = outcome[w_id]
+        if not booked:
+            failed += 1
+    results.put(failed)
+
+
+def run(n_shards, n_writers, n_orders):
+    workdir = tempfile.mkdtemp()
+    shards = build(workdir, n_shards)
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(
+            target=writer, args=(workdir, shards, n_orders, seed, start, results)
+        )
+        for seed in range(n_writers)
+    ]
+    for proc in procs:
+        proc.start()
+    time.sleep(2)  # let every writer import the app before the clock starts
+    began = time.perf_counter()
+    start.set()
+    failed = sum(results.get() for _ in procs)
+    elapsed = time.perf_counter() - began
+    for proc in procs:
+        proc.join()
+
+    booked = 0
+    for path in shards.values():
+        conn = sqlite3.connect(path)
+        booked += conn.execute("SELECT COUNT(*) FROM Orders").fetchone()[0]
+        conn.close()
+    assert not failed and booked == n_writers * n_orders, "lost orders: {}".format(
+        n_writers * n_orders - booked
+    )
+    print(
+        "shards={:<2} writers={:<2} {:8.0f} orders/s  ({:.2f}s)".format(
+            n_shards, n_writers, booked / elapsed, elapsed
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--orders", type=int, default=300, help="per writer")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+    print("cpus: {}".format(os.cpu_count()))
+    for n_shards in args.shards:
+        run(n_shards, args.writers, args.orders)
+
+
+if __name__ == "__main__":
+    main()
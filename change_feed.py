@@ -0,0 +1,249 @@
+# ----------------------------------------------------
+# Stock Change Feed (Server-Sent Events)
+# ----------------------------------------------------
+#
+# Every route that changes stock or orders appends a row to its warehouse
+# shard's StockEvents table inside its own transaction, so each shard has an
+# append-only log and event_id is a strictly increasing sequence per shard.
+# A client's position is therefore one event id per warehouse, sent as the
+# SSE id in the form "1:45.2:17" (warehouse 1 up to event 45, 2 up to 17).
+#
+# Each event carries two stock figures. "warehouse_weight" is the event's
+# own warehouse right after the change. "weight" is the item's CURRENT
+# total over all warehouses, read when the event is sent (polled or
+# replayed), not the total as of the event: an exact historical total
+# would need a cross-shard read inside every write. Pages only use it to
+# show the latest stock, so a later value is the one they want.
+#
+# Each worker process runs ONE background poller that tails every shard and
+# hands new rows to the SSE subscribers held by that process. Subscribers
+# only wait on an in-memory queue, so an idle connection costs a queue and a
+# greenlet (gunicorn gevent worker, see Procfile) instead of a worker and a
+# database query per poll.
+
+import json
+import queue
+import threading
+import time
+
+
+def record_stock_event(conn, kind, item_id, order_id=None):
+    # Must be called on the same shard connection (and before the commit) as
+    # the change it describes. It snapshots this warehouse's stock AFTER the
+    # change.
+    conn.execute(
+        "INSERT INTO StockEvents (kind, item_id, c_id, weight, order_id) "
+        "SELECT ?, Items.id, Items.c_id, COALESCE(Stock.weight, 0), ? "
+        "FROM catalog.Items LEFT JOIN Stock ON Stock.item_id = Items.id "
+        "WHERE Items.id = ?",
+        (kind, order_id, item_id),
+    )
+
+
+def record_order_events(conn, kind, order_ids_query):
+    # Set-based record_stock_event() for a batch of orders. order_ids_query
+    # is a trusted SELECT returning order_id; call it before the orders are
+    # deleted (and after any stock update) in the same transaction.
+    conn.execute(
+        "INSERT INTO StockEvents (kind, item_id, c_id, weight, order_id) "
+        "SELECT ?, Items.id, Items.c_id, COALESCE(Stock.weight, 0), Orders.order_id "
+        "FROM Orders JOIN catalog.Items ON Items.id = Orders.item_id "
+        "LEFT JOIN Stock ON Stock.item_id = Orders.item_id "
+        "WHERE Orders.order_id IN ({}) ORDER BY Orders.order_id".format(
+            order_ids_query
+        ),
+        (kind,),
+    )
+
+
+def parse_cursor(value):
+    """Parse a Last-Event-ID ("1:45.2:17") into {w_id: event_id}."""
+    if not value:
+        return None
+    try:
+        if ":" not in value:
+            return {1: int(value)}  # ids sent before warehouses existed
+        return {
+            int(w_id): int(event_id)
+            for w_id, event_id in (part.split(":") for part in value.split("."))
+        }
+    except ValueError:
+        return None
+
+
+def format_cursor(cursor):
+    return ".".join("{}:{}".format(w_id, cursor[w_id]) for w_id in sorted(cursor))
+
+
+def format_sse(change, cursor, include_orders=True):
+    w_id, event, total = change
+    data = {
+        "event_id": event["event_id"],
+        "kind": event["kind"],
+        "item_id": event["item_id"],
+        "c_id": event["c_id"],
+        "weight": total,  # current total across warehouses, see top of file
+        "warehouse": w_id,
+        "warehouse_weight": event["weight"],
+        "created": event["created"],
+    }
+    if include_orders:
+        data["order_id"] = event["order_id"]
+    return "id: {}\nevent: stock\ndata: {}\n\n".format(
+        format_cursor(cursor), json.dumps(data)
+    )
+
+
+class Subscription:
+    def __init__(self, c_id=None, item_id=None, max_pending=256):
+        self.c_id = c_id
+        self.item_id = item_id
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.overflowed = False
+        self.start = {}  # feed position when subscribed
+
+    def matches(self, event):
+        if self.item_id is not None and event["item_id"] != self.item_id:
+            return False
+        if self.c_id is not None and event["c_id"] != self.c_id:
+            return False
+        return True
+
+    def offer(self, change):
+        # Never block the poller on a slow client. If the client can't keep
+        # up we drop it; the browser reconnects with Last-Event-ID and
+        # catches up from the tables.
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeFeed:
+    def __init__(
+        self, warehouses, poll_interval=0.5, heartbeat=15.0, backlog_limit=500
+    ):
+        self._warehouses = warehouses
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.backlog_limit = backlog_limit
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._poller = None
+        self._cursor = {}
+
+    def subscribe(self, c_id=None, item_id=None):
+        sub = Subscription(c_id, item_id)
+        with self._lock:
+            self._subscribers.add(sub)
+            if self._poller is None:
+                # Set the cursor before returning so no event committed after
+                # this point can fall between a resume backfill and the poller.
+                latest = self._warehouses.fan_out(
+                    lambda conn, w_id: conn.execute(
+                        "SELECT MAX(event_id) FROM StockEvents"
+                    ).fetchone()[0]
+                )
+                self._cursor = {w_id: last or 0 for w_id, last in latest.items()}
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+            sub.start = dict(self._cursor)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def _read(self, cursor, limit, c_id=None, item_id=None):
+        # New rows from every shard, each paired with the item's current
+        # total stock (read now, not as of the event).
+        # Also returns whether any shard hit the limit (more rows waiting).
+        query = "SELECT * FROM StockEvents WHERE event_id > ?"
+        filters = []
+        if c_id is not None:
+            query += " AND c_id = ?"
+            filters.append(c_id)
+        if item_id is not None:
+            query += " AND item_id = ?"
+            filters.append(item_id)
+        query += " ORDER BY event_id LIMIT ?"
+
+        per_shard = self._warehouses.fan_out(
+            lambda conn, w_id: conn.execute(
+                query, [cursor.get(w_id, 0)] + filters + [limit]
+            ).fetchall()
+        )
+        changes = [
+            (w_id, event) for w_id, events in per_shard.items() for event in events
+        ]
+        totals = self._warehouses.stock_totals(
+            {event["item_id"] for _, event in changes}
+        )
+        full = any(len(events) >= limit for events in per_shard.values())
+        return [
+            (w_id, event, totals.get(event["item_id"], 0)) for w_id, event in changes
+        ], full
+
+    def _poll(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        # Nobody is listening: stop polling until the next
+                        # subscriber restarts us.
+                        self._poller = None
+                        return
+                changes, full = self._read(self._cursor, 500)
+                if changes:
+                    with self._lock:
+                        for w_id, event, _ in changes:
+                            self._cursor[w_id] = max(
+                                self._cursor.get(w_id, 0), event["event_id"]
+                            )
+                        subscribers = list(self._subscribers)
+                    for change in changes:
+                        for sub in subscribers:
+                            if sub.matches(change[1]):
+                                sub.offer(change)
+                    if full:
+                        continue
+                time.sleep(self.poll_interval)
+        except Exception as e:
+            print(f"Stock feed poller stopped: {e}")
+            with self._lock:
+                self._poller = None
+                for sub in self._subscribers:
+                    sub.overflowed = True
+
+    def stream(self, cursor=None, c_id=None, item_id=None, include_orders=True):
+        sub = self.subscribe(c_id, item_id)
+        try:
+            yield "retry: 3000\n\n"
+            seen = dict(cursor or sub.start)
+            if cursor is not None:
+                missed, full = self._read(
+                    cursor, self.backlog_limit + 1, c_id, item_id
+                )
+                if full or len(missed) > self.backlog_limit:
+                    # Too far behind to replay: ask the page to reload.
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                for change in missed:
+                    seen[change[0]] = change[1]["event_id"]
+                    yield format_sse(change, seen, include_orders)
+
+            # An overflowed queue is full, so get() never blocks and the
+            # loop notices the flag straight away.
+            while not sub.overflowed:
+                try:
+                    change = sub.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                w_id, event, _ = change
+                if event["event_id"] <= seen.get(w_id, 0):
+                    continue
+                seen[w_id] = event["event_id"]
+                yield format_sse(change, seen, include_orders)
+        finally:
+            self.unsubscribe(sub)
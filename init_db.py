@@ -1,7 +1,27 @@
+import os
 import sqlite3
 from werkzeug.security import generate_password_hash
+from warehouses import init_shard, parse_warehouses
 
-connection = sqlite3.connect("database.db")
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    # Let maintenance.py hand free pages back to the OS a few at a time
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    return connection
+
+
+def finish(connection):
+    connection.commit()
+    # auto_vacuum only takes effect on an existing file after a VACUUM.
+    # WAL lets readers (pages, the stock feed) run alongside a writer.
+    connection.execute("VACUUM")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.close()
+
+
+# Catalog: admins, users, categories and items
+connection = connect("database.db")
 
 with open("schema.sql") as f:
     connection.executescript(f.read())
@@ -20,7 +40,17 @@ cur.execute(
     (admin_id, admin_username, admin_password_hashed),
 )
 
-connection.commit()
-connection.close()
+finish(connection)
+
+# One shard per warehouse for stock and orders (may be database.db itself)
+warehouses = parse_warehouses(os.environ.get("WAREHOUSES", "1=database.db"))
+for w_id, path in warehouses.items():
+    connection = connect(path)
+    init_shard(connection, w_id)
+    finish(connection)
 
-print("Database initialized successfully with a new admin user.")
+print(
+    "Database initialized successfully with a new admin user and {} warehouse(s).".format(
+        len(warehouses)
+    )
+)
@@ -0,0 +1,208 @@
+# ----------------------------------------------------
+# Shared Inventory Snapshot
+# ----------------------------------------------------
+#
+# A compact copy of (stock, price, category) for every item, kept in a
+# memory-mapped file that all workers on the node share. Records are packed
+# in an array indexed by item id, so a lookup is one struct unpack at a
+# fixed offset: no SQLite connection, no query, no lock.
+#
+# File layout:
+#   header: magic, seq, version, capacity
+#   records[capacity]: stock (double), price (double), c_id (int64, 0 = none)
+#
+# Writers (serialised with flock) make `seq` odd while they write and even
+# again when done, bumping `version` each time. Readers retry if they see an
+# odd or changed `seq` (a seqlock), so they never block and never see a
+# half-written record. A reader that keeps losing the race (or finds `seq`
+# stuck odd after a writer died mid-update) gives up after _MAX_RETRIES and
+# reads the item from the database instead.
+
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+_MAGIC = b"IMSINV01"
+_HEADER = struct.Struct("<8sQQQ")  # magic, seq, version, capacity
+_SEQ = struct.Struct("<Q")
+_SEQ_OFFSET = 8
+_RECORD = struct.Struct("<ddq")  # stock, price, c_id
+_GROW = 1024
+_MAX_RETRIES = 10000
+
+StockEntry = collections.namedtuple("StockEntry", ["stock", "price", "c_id"])
+
+
+def default_path(database):
+    digest = hashlib.blake2b(
+        os.path.abspath(database).encode(), digest_size=8
+    ).hexdigest()
+    return os.path.join(tempfile.gettempdir(), "ims_inventory_{}.bin".format(digest))
+
+
+class InventorySnapshot:
+    def __init__(self, load_rows, path=None, database="database.db"):
+        # load_rows(item_ids) returns (id, stock, price, c_id) rows for those
+        # items, or for every item when item_ids is None. Without a path the
+        # file is named after the absolute path of `database`, so two
+        # deployments on one host never share (and overwrite) a snapshot.
+        self._load_rows = load_rows
+        self.path = path or default_path(database)
+        self._lock = threading.RLock()
+        self._fd = None
+        self._map = None
+        self._capacity = 0
+        self._ready = False
+
+    # ---- reading ----
+
+    def lookup(self, item_id):
+        """Return StockEntry for the item, or None if it doesn't exist."""
+        if not self._ready:
+            self._open()
+        for _ in range(_MAX_RETRIES):
+            seq = _SEQ.unpack_from(self._map, _SEQ_OFFSET)[0]
+            if seq & 1:
+                continue  # a writer is mid-update
+            capacity = self._header()[3]
+            if item_id < 0 or item_id >= capacity:
+                entry = None
+            else:
+                if capacity > self._capacity:
+                    self._remap()
+                entry = StockEntry(*_RECORD.unpack_from(self._map, self._offset(item_id)))
+            if _SEQ.unpack_from(self._map, _SEQ_OFFSET)[0] == seq:
+                if entry is None or entry.c_id == 0:
+                    return None
+                return entry
+        return self._load_entry(item_id)
+
+    @property
+    def version(self):
+        if not self._ready:
+            self._open()
+        return self._header()[2]
+
+    # ---- writing ----
+
+    def refresh(self, item_ids=None):
+        """Re-read items from the database and publish them.
+
+        Call after committing any change to Items. With no ids the whole
+        snapshot is rebuilt (used once per worker on first use).
+        """
+        if not self._ready:
+            self._open()  # builds the whole snapshot
+            return
+        if item_ids is not None:
+            item_ids = [int(i) for i in item_ids]
+            if not item_ids:
+                return
+        self._publish(item_ids)
+
+    # ---- internals ----
+
+    def _load_entry(self, item_id):
+        rows = self._coerce(self._load_rows([item_id]))
+        if not rows:
+            return None
+        return StockEntry(*rows[0][1:])
+
+    @staticmethod
+    def _coerce(rows):
+        # Everything is converted before a writer touches the file, so a bad
+        # row can't fail half way through an update. Rows that don't convert
+        # (e.g. a blank price) are left out: the item reads as missing.
+        clean = []
+        for row in rows:
+            try:
+                item_id, weight, price, c_id = row
+                clean.append((int(item_id), float(weight), float(price), int(c_id)))
+            except (TypeError, ValueError) as e:
+                print(f"Inventory snapshot: skipping item row {tuple(row)!r}: {e}")
+        return clean
+
+    def _publish(self, item_ids):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                # Read under the file lock so a slower writer can never
+                # overwrite newer rows with older ones.
+                rows = self._coerce(self._load_rows(item_ids))
+                found = {row[0]: row for row in rows}
+                magic, seq, version, capacity = self._header()
+                if capacity > self._capacity:
+                    self._remap()
+                needed = max(found, default=0) + 1
+                if needed > capacity:
+                    capacity = -(-needed // _GROW) * _GROW
+                    os.ftruncate(self._fd, _HEADER.size + capacity * _RECORD.size)
+                    self._remap()
+
+                _SEQ.pack_into(self._map, _SEQ_OFFSET, seq + 1)
+                try:
+                    if item_ids is None:
+                        # Full rebuild: clear everything, including deleted items
+                        self._map[_HEADER.size :] = bytes(capacity * _RECORD.size)
+                    else:
+                        for item_id in item_ids:
+                            if item_id not in found and 0 <= item_id < capacity:
+                                _RECORD.pack_into(
+                                    self._map, self._offset(item_id), 0, 0, 0
+                                )
+                    for item_id, weight, price, c_id in rows:
+                        _RECORD.pack_into(
+                            self._map, self._offset(item_id), weight, price, c_id
+                        )
+                finally:
+                    # Never leave seq odd: readers would spin on it forever
+                    _HEADER.pack_into(
+                        self._map, 0, magic, seq + 2, version + 1, capacity
+                    )
+                self._capacity = capacity
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _header(self):
+        return _HEADER.unpack_from(self._map, 0)
+
+    def _offset(self, item_id):
+        return _HEADER.size + item_id * _RECORD.size
+
+    def _open(self):
+        with self._lock:
+            if self._ready:
+                return
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < _HEADER.size:
+                    os.ftruncate(fd, _HEADER.size)
+                buf = mmap.mmap(fd, 0)
+                magic, seq, version, capacity = _HEADER.unpack_from(buf, 0)
+                if magic != _MAGIC:
+                    _HEADER.pack_into(buf, 0, _MAGIC, 0, 0, 0)
+                elif seq & 1:
+                    # A writer died mid-update (we hold the lock, so nobody is
+                    # writing now). The rebuild below rewrites every record.
+                    _SEQ.pack_into(buf, _SEQ_OFFSET, seq + 1)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._fd = fd
+            self._map = buf
+            self._capacity = _HEADER.unpack_from(buf, 0)[3]
+            # The file may predate this process (or the database may have
+            # been changed offline), so every worker rebuilds it on first use.
+            self._publish(None)
+            self._ready = True
+
+    def _remap(self):
+        # Called when another process (or we) grew the file. The old mapping
+        # is left for the garbage collector since a reader may still hold it.
+        self._map = mmap.mmap(self._fd, 0)
+        self._capacity = _HEADER.unpack_from(self._map, 0)[3]
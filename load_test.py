@@ -0,0 +1,131 @@
+# ----------------------------------------------------
+# Load test: catalog responsiveness under a login flood
+# ----------------------------------------------------
+#
+# Start the app the way it runs in production, behind one proxy hop, e.g.
+#     PROXY_FIX_HOPS=1 gunicorn --worker-class gevent --workers 2 app:app
+# then run
+#     python load_test.py --username <user> --password <password> --c-id 1
+#
+# It measures catalog page latency on its own, then again while many threads
+# hammer /sign_in and /user_signin with bad passwords, and prints both.
+# Every flood request claims a different client address in X-Forwarded-For
+# (trusted because of PROXY_FIX_HOPS), so the per-IP buckets don't turn the
+# flood away and the logins reach the password hash and its concurrency cap,
+# as a distributed flood would.
+
+import argparse
+import collections
+import statistics
+import threading
+import time
+
+import requests
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def measure_catalog(browser, base_url, c_id, duration):
+    url = "{}/u_category/{}/u_items_list".format(base_url, c_id)
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        resp = browser.get(url, allow_redirects=False)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if resp.status_code != 200:
+            errors += 1
+        time.sleep(0.05)
+    return latencies, errors
+
+
+def flood(base_url, stop, statuses, lock, thread_no):
+    attacker = requests.Session()
+    n = 0
+    while not stop.is_set():
+        n += 1
+        # 10.<thread>.x.y: a fresh address for each request
+        client_ip = "10.{}.{}.{}".format(thread_no % 256, n // 256 % 256, n % 256)
+        if n % 2:
+            path, data = "/sign_in", {"username": "admin", "password": "wrong%d" % n}
+        else:
+            path = "/user_signin"
+            data = {"u_username": "user%d" % n, "u_password": "wrong"}
+        try:
+            resp = attacker.post(
+                base_url + path,
+                data=data,
+                headers={"X-Forwarded-For": client_ip},
+                allow_redirects=False,
+            )
+            code = resp.status_code
+        except requests.RequestException:
+            code = "error"
+        with lock:
+            statuses[code] += 1
+
+
+def report(label, latencies, errors):
+    print(
+        "{:<22} requests={:<5} p50={:7.1f}ms p95={:7.1f}ms max={:7.1f}ms "
+        "non-200={}".format(
+            label,
+            len(latencies),
+            statistics.median(latencies),
+            percentile(latencies, 95),
+            max(latencies),
+            errors,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--c-id", type=int, default=1)
+    parser.add_argument("--flood-threads", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    # Sign the shopper in before the flood, so the measured pages never
+    # compete with the flood for a login slot.
+    browser = requests.Session()
+    browser.post(
+        args.base_url + "/user_signin",
+        data={"u_username": args.username, "u_password": args.password},
+    )
+
+    latencies, errors = measure_catalog(
+        browser, args.base_url, args.c_id, args.duration
+    )
+    report("catalog (idle)", latencies, errors)
+
+    stop = threading.Event()
+    statuses, lock = collections.Counter(), threading.Lock()
+    attackers = [
+        threading.Thread(
+            target=flood, args=(args.base_url, stop, statuses, lock, thread_no)
+        )
+        for thread_no in range(args.flood_threads)
+    ]
+    for t in attackers:
+        t.start()
+    time.sleep(1)  # let the flood ramp up
+
+    latencies, errors = measure_catalog(
+        browser, args.base_url, args.c_id, args.duration
+    )
+    stop.set()
+    for t in attackers:
+        t.join()
+    report("catalog (login flood)", latencies, errors)
+    print("login flood responses:", dict(statuses))
+
+
+if __name__ == "__main__":
+    main()
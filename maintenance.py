@@ -0,0 +1,312 @@
+# ----------------------------------------------------
+# Database Maintenance Scheduler
+# ----------------------------------------------------
+#
+# Runs as its own process next to the web workers (see Procfile):
+#     python maintenance.py                  # run the scheduler forever
+#     python maintenance.py --once backup    # run given task(s) now and exit
+#     python maintenance.py --once enable-incremental-vacuum  # one-off, see below
+#
+# Each task has an interval; heavy tasks only run inside the low-traffic
+# window (MAINTENANCE_WINDOW, local time, e.g. "02:00-05:00"). Tasks work in
+# small steps with pauses and a short busy timeout, so request writers are
+# never stalled for long, and every run is recorded in MaintenanceLog with
+# its duration and the database/WAL file sizes before and after.
+#
+# Every task runs over the catalog and each warehouse shard (WAREHOUSES, see
+# warehouses.py); the log itself is kept in the catalog.
+
+import argparse
+import calendar
+import datetime
+import glob
+import os
+import sqlite3
+import time
+
+from warehouses import parse_warehouses
+
+DATABASE = "database.db"
+WAREHOUSES = parse_warehouses(os.environ.get("WAREHOUSES", "1=database.db"))
+# Catalog first, then each distinct shard file
+DATABASES = list(dict.fromkeys([DATABASE] + list(WAREHOUSES.values())))
+
+# Seconds between runs of each task
+INTERVALS = {
+    "checkpoint": int(os.environ.get("MAINT_CHECKPOINT_INTERVAL", 15 * 60)),
+    "optimize": int(os.environ.get("MAINT_OPTIMIZE_INTERVAL", 6 * 3600)),
+    "cleanup": int(os.environ.get("MAINT_CLEANUP_INTERVAL", 24 * 3600)),
+    "analyze": int(os.environ.get("MAINT_ANALYZE_INTERVAL", 24 * 3600)),
+    "vacuum": int(os.environ.get("MAINT_VACUUM_INTERVAL", 24 * 3600)),
+    "backup": int(os.environ.get("MAINT_BACKUP_INTERVAL", 24 * 3600)),
+}
+# Tasks that may only start inside the low-traffic window
+WINDOW_ONLY = {"cleanup", "analyze", "vacuum", "backup"}
+MAINTENANCE_WINDOW = os.environ.get("MAINTENANCE_WINDOW", "02:00-05:00")
+
+TICK_SECONDS = 60
+BUSY_TIMEOUT_MS = 2000  # give up quickly instead of queueing behind writers
+STEP_PAUSE = 0.05  # seconds to yield to request writers between steps
+STOCK_EVENT_RETENTION_DAYS = int(os.environ.get("STOCK_EVENT_RETENTION_DAYS", 7))
+CLEANUP_BATCH_ROWS = 1000
+VACUUM_STEP_PAGES = 200
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", 100))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))
+
+
+def get_db_connection(path=DATABASE):
+    # Autocommit, so each statement/batch holds the write lock only briefly
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT_MS))
+    return conn
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def in_window(now=None):
+    start, end = [
+        datetime.datetime.strptime(t.strip(), "%H:%M").time()
+        for t in MAINTENANCE_WINDOW.split("-")
+    ]
+    now = (now or datetime.datetime.now()).time()
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end  # window wraps past midnight
+
+
+# ---- tasks: each returns a short detail string for the log ----
+
+
+def checkpoint(conn):
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        return "skipped: not in WAL mode"
+    # PASSIVE never waits on readers or writers; inside the quiet window we
+    # also truncate the WAL file back to zero.
+    mode = "TRUNCATE" if in_window() else "PASSIVE"
+    busy, log_pages, done = conn.execute(
+        "PRAGMA wal_checkpoint({})".format(mode)
+    ).fetchone()
+    return "{}: {} of {} pages{}".format(
+        mode, done, log_pages, " (busy)" if busy else ""
+    )
+
+
+def optimize(conn):
+    conn.execute("PRAGMA optimize")
+    return "ok"
+
+
+def analyze(conn):
+    # Bound the rows sampled per index so ANALYZE stays cheap as tables grow
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
+    return "ok"
+
+
+def cleanup(conn):
+    # The stock change feed only needs recent events for SSE resume
+    if not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'StockEvents'"
+    ).fetchone():
+        return "skipped: no StockEvents (catalog only)"
+    cutoff = "-{} days".format(STOCK_EVENT_RETENTION_DAYS)
+    deleted = 0
+    while True:
+        cur = conn.execute(
+            "DELETE FROM StockEvents WHERE event_id IN ("
+            " SELECT event_id FROM StockEvents"
+            " WHERE created < datetime('now', ?) ORDER BY event_id LIMIT ?)",
+            (cutoff, CLEANUP_BATCH_ROWS),
+        )
+        deleted += cur.rowcount
+        if cur.rowcount < CLEANUP_BATCH_ROWS:
+            break
+        time.sleep(STEP_PAUSE)
+    return "deleted {} stock events".format(deleted)
+
+
+def vacuum(conn):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return (
+            "skipped: auto_vacuum is not INCREMENTAL"
+            " (run: python maintenance.py --once enable-incremental-vacuum)"
+        )
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    free = free_before
+    while free > 0:
+        # The pragma frees one page per step and execute() only steps it
+        # once; executescript() runs it to completion.
+        conn.executescript("PRAGMA incremental_vacuum({});".format(VACUUM_STEP_PAGES))
+        remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            break  # nothing more can be released right now
+        free = remaining
+        time.sleep(STEP_PAUSE)
+    return "released {} free pages".format(free_before - free)
+
+
+def enable_incremental_vacuum(conn):
+    # One-off, never scheduled: files not created by init_db.py (a database.db
+    # from before it set auto_vacuum, shards made by migrate_warehouses.py)
+    # start with auto_vacuum off. The setting only takes effect through a
+    # full VACUUM, which rebuilds the file keeping every row but holds the
+    # write lock until it finishes, so run it while traffic is low.
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return "skipped: auto_vacuum is already INCREMENTAL"
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return "auto_vacuum is now INCREMENTAL"
+
+
+def backup(conn):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    # Named after the source file: database-<stamp>.db, warehouse_2-<stamp>.db
+    source = conn.execute("PRAGMA database_list").fetchone()["file"]
+    name = os.path.splitext(os.path.basename(source))[0]
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    target = os.path.join(BACKUP_DIR, "{}-{}.db".format(name, stamp))
+    dest = sqlite3.connect(target)
+    try:
+        # Copies BACKUP_PAGES_PER_STEP pages at a time and sleeps in between,
+        # so writers get the database back between steps.
+        conn.backup(dest, pages=BACKUP_PAGES_PER_STEP, sleep=STEP_PAUSE)
+    finally:
+        dest.close()
+
+    backups = sorted(glob.glob(os.path.join(BACKUP_DIR, "{}-*.db".format(name))))
+    for old in backups[:-BACKUP_KEEP]:
+        os.remove(old)
+    return "{} ({} bytes)".format(target, file_size(target))
+
+
+TASKS = {
+    "checkpoint": checkpoint,
+    "optimize": optimize,
+    "cleanup": cleanup,
+    "analyze": analyze,
+    "vacuum": vacuum,
+    "backup": backup,
+    # Not in INTERVALS: only run on request with --once
+    "enable-incremental-vacuum": enable_incremental_vacuum,
+}
+
+
+# ---- scheduler ----
+
+
+def run_task(name):
+    # Runs the task on every database; "ok" only if it succeeded everywhere.
+    # All rows of one run share `started`, which is how last_runs() groups
+    # them back together.
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    statuses = [run_task_on(name, path, started) for path in DATABASES]
+    return "ok" if all(status == "ok" for status in statuses) else "error"
+
+
+def run_task_on(name, path, started):
+    wal = path + "-wal"
+    db_before, wal_before = file_size(path), file_size(wal)
+    start = time.perf_counter()
+    conn = None
+    try:
+        conn = get_db_connection(path)
+        detail = TASKS[name](conn)
+        status = "ok"
+    except Exception as e:
+        # Any failure (locked database, full disk, unwritable BACKUP_DIR...)
+        # is logged and retried later; it must not kill the scheduler.
+        detail = "{}: {}".format(type(e).__name__, e)
+        status = "error"
+    finally:
+        if conn is not None:
+            conn.close()
+    duration_ms = (time.perf_counter() - start) * 1000
+
+    row = (
+        name,
+        status,
+        started,
+        duration_ms,
+        db_before,
+        file_size(path),
+        wal_before,
+        file_size(wal),
+        "{}: {}".format(path, detail),
+    )
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "INSERT INTO MaintenanceLog (task, status, started, duration_ms,"
+            " db_size_before, db_size_after, wal_size_before, wal_size_after,"
+            " detail) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            row,
+        )
+    except sqlite3.Error as e:
+        print(f"Could not record maintenance run: {e}")
+    finally:
+        conn.close()
+    print(
+        "[maintenance] {} {} in {:.0f}ms db {}->{} wal {}->{}: {}".format(
+            name, status, duration_ms, *row[4:]
+        )
+    )
+    return status
+
+
+def last_runs():
+    # Resume the schedule after a restart instead of running everything again.
+    # A run only counts if it succeeded on every database.
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT task, MAX(started) AS started FROM ("
+        " SELECT task, started FROM MaintenanceLog GROUP BY task, started"
+        " HAVING SUM(status != 'ok') = 0)"
+        " GROUP BY task"
+    ).fetchall()
+    conn.close()
+    return {
+        row["task"]: calendar.timegm(time.strptime(row["started"], "%Y-%m-%d %H:%M:%S"))
+        for row in rows
+    }
+
+
+def run_forever():
+    last = last_runs()
+    while True:
+        now = time.time()
+        for name, interval in INTERVALS.items():
+            if now - last.get(name, 0) < interval:
+                continue
+            if name in WINDOW_ONLY and not in_window():
+                continue
+            # Failed runs are retried on the next tick
+            if run_task(name) == "ok":
+                last[name] = time.time()
+        time.sleep(TICK_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--once",
+        nargs="+",
+        choices=sorted(TASKS),
+        help="run these tasks immediately and exit",
+    )
+    args = parser.parse_args()
+    if args.once:
+        for name in args.once:
+            run_task(name)
+    else:
+        run_forever()
+
+
+if __name__ == "__main__":
+    main()
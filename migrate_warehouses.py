@@ -0,0 +1,154 @@
+# ----------------------------------------------------
+# Migrate an existing database.db to the multi-warehouse layout
+# ----------------------------------------------------
+#
+#     WAREHOUSES="1=database.db,2=warehouse_2.db" python migrate_warehouses.py
+#
+# Before warehouses, database.db held everything: Items.weight was the
+# stock and Orders/History/StockEvents sat next to the catalog. This moves
+# that data to warehouse 1 (whose order-id range the existing ids are in):
+#   - Items.weight -> Stock rows of warehouse 1, then the column is dropped
+#     from the catalog
+#   - Orders, History and StockEvents -> warehouse 1's shard (left in place
+#     when that shard is database.db itself, the default)
+# and creates any missing catalog/shard tables, seeding the order-id range
+# of new shards. Every file is switched to WAL.
+#
+# Safe to run again: each step checks whether it is still needed. Stop the
+# web workers first (and take a backup: python maintenance.py --once backup).
+
+import os
+import re
+import sqlite3
+
+from warehouses import ORDER_ID_SPAN, init_shard, parse_warehouses
+
+DATABASE = "database.db"
+MOVED_TABLES = ["Orders", "History", "StockEvents"]
+
+
+def create_missing_tables(conn, schema_path):
+    # The schema files recreate everything from scratch (DROP + CREATE);
+    # here we only want the tables that don't exist yet.
+    with open(schema_path) as f:
+        script = f.read()
+    script = re.sub(r"DROP TABLE IF EXISTS \w+;", "", script)
+    script = script.replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ")
+    conn.executescript(script)
+
+
+def columns(conn, table, schema="main"):
+    return [
+        row[1]
+        for row in conn.execute("PRAGMA {}.table_info({})".format(schema, table))
+    ]
+
+
+def has_table(conn, table, schema="main"):
+    return bool(columns(conn, table, schema))
+
+
+def migrate_catalog(conn, first_w_id, first_path):
+    same_file = os.path.abspath(first_path) == os.path.abspath(DATABASE)
+    create_missing_tables(conn, "schema.sql")
+    if same_file:
+        # Only Stock is new; Orders/History/StockEvents stay where they are
+        shard = "main"
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS Stock("
+            " item_id INTEGER PRIMARY KEY, weight integer not null)"
+        )
+    else:
+        shard = "shard"
+        if not os.path.exists(first_path):
+            init_conn = sqlite3.connect(first_path)
+            init_shard(init_conn, first_w_id)
+            init_conn.close()
+        conn.execute("ATTACH DATABASE ? AS shard", (first_path,))
+        if not has_table(conn, "Stock", shard):
+            raise SystemExit(
+                "{} exists but is not a warehouse shard".format(first_path)
+            )
+
+    conn.execute("BEGIN IMMEDIATE")
+    if "weight" in columns(conn, "Items"):
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO {}.Stock (item_id, weight)"
+            " SELECT id, weight FROM main.Items".format(shard)
+        )
+        print(
+            "moved stock of {} items to warehouse {}".format(
+                cur.rowcount, first_w_id
+            )
+        )
+    if not same_file:
+        for table in MOVED_TABLES:
+            if not has_table(conn, table):
+                continue
+            # The old tables may have fewer columns than the shard ones
+            shared = ", ".join(columns(conn, table))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO shard.{0} ({1}) SELECT {1} FROM main.{0}".format(
+                    table, shared
+                )
+            )
+            print(
+                "moved {} {} rows to warehouse {}".format(
+                    cur.rowcount, table, first_w_id
+                )
+            )
+    conn.execute("COMMIT")
+
+    # Schema changes after the data is safely copied
+    if "weight" in columns(conn, "Items"):
+        conn.execute("ALTER TABLE Items DROP COLUMN weight")
+    if not same_file:
+        for table in MOVED_TABLES:
+            conn.execute("DROP TABLE IF EXISTS main.{}".format(table))
+        conn.execute("DETACH DATABASE shard")
+
+
+def migrate_shard(path, w_id):
+    conn = sqlite3.connect(path)
+    if not has_table(conn, "Orders"):
+        init_shard(conn, w_id)
+    else:
+        create_missing_tables(conn, "shard_schema.sql")
+        high = conn.execute("SELECT MAX(order_id) FROM Orders").fetchone()[0] or 0
+        low = (w_id - 1) * ORDER_ID_SPAN
+        if high and not low <= high < low + ORDER_ID_SPAN:
+            raise SystemExit(
+                "{}: order ids up to {} are outside warehouse {}'s range".format(
+                    path, high, w_id
+                )
+            )
+        if w_id > 1 and not high:
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'Orders', ?"
+                " WHERE NOT EXISTS ("
+                " SELECT 1 FROM sqlite_sequence WHERE name = 'Orders')",
+                (low,),
+            )
+    conn.commit()
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+
+def main():
+    warehouses = parse_warehouses(os.environ.get("WAREHOUSES", "1=database.db"))
+    if 1 not in warehouses:
+        raise SystemExit("WAREHOUSES must include warehouse 1 for the existing data")
+    first_w_id = 1
+
+    conn = sqlite3.connect(DATABASE, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    migrate_catalog(conn, first_w_id, warehouses[first_w_id])
+    conn.close()
+
+    for w_id, path in sorted(warehouses.items()):
+        migrate_shard(path, w_id)
+    print("Migrated {} to {} warehouse(s).".format(DATABASE, len(warehouses)))
+
+
+if __name__ == "__main__":
+    main()
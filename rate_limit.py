@@ -0,0 +1,175 @@
+# ----------------------------------------------------
+# Rate Limiting and Admission Control
+# ----------------------------------------------------
+#
+# Token buckets live in a small memory-mapped file so every gunicorn worker
+# on the node sees the same counts. A bucket is found by hashing its key
+# ("login:ip:1.2.3.4") into a fixed table of slots; updates are guarded by
+# flock on the file plus a thread lock for greenlets/threads in one worker.
+#
+# Rejections are decided before the view runs, so a flood of 429s never
+# touches the database, hashes a password or calls Stripe.
+
+import fcntl
+import functools
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from flask import Response, request, session
+
+_MAGIC = b"IMSRL001"
+_HEADER = struct.Struct("<8sQ")  # magic, slot count
+_SLOT = struct.Struct("<Qdd")  # key hash, tokens, last refill time
+_PROBES = 8
+
+
+def default_path(database):
+    digest = hashlib.blake2b(
+        os.path.abspath(database).encode(), digest_size=8
+    ).hexdigest()
+    return os.path.join(tempfile.gettempdir(), "ims_ratelimit_{}.bin".format(digest))
+
+
+class BucketStore:
+    def __init__(self, path=None, slots=8192, database="database.db"):
+        # Without a path the file is named after the absolute path of
+        # `database`, so two deployments on one host keep separate buckets.
+        self.path = path or default_path(database)
+        self.slots = slots
+        self._size = _HEADER.size + slots * _SLOT.size
+        self._lock = threading.Lock()
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != self._size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self._size)
+            buf = mmap.mmap(fd, self._size)
+            magic, slots = _HEADER.unpack_from(buf, 0)
+            if magic != _MAGIC or slots != self.slots:
+                buf[:] = bytes(self._size)
+                _HEADER.pack_into(buf, 0, _MAGIC, self.slots)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._map = buf
+
+    def take(self, key, rate, burst):
+        """Take one token from the bucket for `key`.
+
+        `rate` is tokens refilled per second and `burst` the bucket size.
+        Returns 0 when allowed, otherwise the seconds until a token is free.
+        """
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        key_hash = int.from_bytes(digest, "little") or 1
+        now = time.time()
+
+        with self._lock:
+            if self._map is None:
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = self._find_slot(key_hash)
+                stored_hash, tokens, last = _SLOT.unpack_from(self._map, offset)
+                if stored_hash != key_hash:
+                    tokens, last = float(burst), now
+                tokens = min(float(burst), tokens + max(0.0, now - last) * rate)
+                if tokens >= 1.0:
+                    tokens -= 1.0
+                    wait = 0.0
+                else:
+                    wait = (1.0 - tokens) / rate
+                _SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait
+
+    def _find_slot(self, key_hash):
+        # Linear probing over a few slots; if all are taken by other keys,
+        # reuse the one idle longest. Losing an idle bucket only resets it.
+        start = key_hash % self.slots
+        victim, victim_last = None, None
+        for i in range(_PROBES):
+            offset = _HEADER.size + ((start + i) % self.slots) * _SLOT.size
+            stored_hash, _, last = _SLOT.unpack_from(self._map, offset)
+            if stored_hash == key_hash or stored_hash == 0:
+                return offset
+            if victim is None or last < victim_last:
+                victim, victim_last = offset, last
+        return victim
+
+
+def too_many_requests(retry_after):
+    return Response(
+        "Too many requests. Please try again later.",
+        status=429,
+        mimetype="text/plain",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def limit_route(
+    store,
+    name,
+    per_ip=None,
+    per_user=None,
+    user_key=None,
+    max_concurrent=None,
+    methods=("POST",),
+):
+    """Decorator applying admission control to a view.
+
+    per_ip / per_user are (rate_per_second, burst) pairs. user_key returns
+    the per-user bucket key from the request or session (never the database).
+    max_concurrent caps in-flight requests for the route in this worker.
+    Put it ABOVE @login_required so rejected requests never load the user.
+    """
+    slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method not in methods:
+                return view(*args, **kwargs)
+
+            wait = 0.0
+            if per_ip:
+                ip_key = "{}:ip:{}".format(name, request.remote_addr)
+                wait = max(wait, store.take(ip_key, *per_ip))
+            # Once the address is over its limit the request is refused
+            # anyway; don't let it drain the named user's bucket too.
+            if per_user and user_key and not wait:
+                user = user_key()
+                if user:
+                    user_bucket = "{}:user:{}".format(name, user)
+                    wait = max(wait, store.take(user_bucket, *per_user))
+            if wait:
+                return too_many_requests(wait)
+
+            if slots is None:
+                return view(*args, **kwargs)
+            if not slots.acquire(blocking=False):
+                return too_many_requests(1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                slots.release()
+
+        return wrapped
+
+    return decorator
+
+
+def session_user_id():
+    # Flask-Login keeps the logged-in id in the signed session cookie
+    return session.get("_user_id")
@@ -2,8 +2,7 @@ DROP TABLE IF EXISTS Admin;
 DROP TABLE IF EXISTS User;
 DROP TABLE IF EXISTS Categories;
 DROP TABLE IF EXISTS Items;
-DROP TABLE IF EXISTS orders;
-DROP TABLE IF EXISTS History;
+DROP TABLE IF EXISTS MaintenanceLog;
 
 CREATE TABLE Admin (
     a_id INTEGER PRIMARY KEY ,
@@ -28,33 +27,22 @@ CREATE TABLE Categories (
 CREATE TABLE Items (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name varchar(20) not null,
-    weight integer not null,
     price_per_unit int not null,
     c_id INTEGER not null,
     FOREIGN KEY (c_id) REFERENCES Categories(c_id)
 );
 
-CREATE TABLE Orders(
-    order_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    u_id INTEGER not null,
-    item_id  integer not null,
-    quantity INTEGER not null,
-    price INTEGER not null,
-    order_dateandtime TIMESTAMP not null DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (u_id) REFERENCES User(u_id)
-    FOREIGN KEY (item_id) REFERENCES Items(id)
-);
 
-CREATE TABLE History(
-    order_id INTEGER PRIMARY KEY,
-    u_id INTEGER not null,
-    item_id  integer not null,
-    quantity INTEGER not null,
-    price INTEGER not null,
-    dat TIMESTAMP not null DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (order_id) REFERENCES Orders(order_id),
-    FOREIGN KEY (u_id) REFERENCES User(u_id),
-    FOREIGN KEY (item_id) REFERENCES Items(id),
-	FOREIGN KEY (dat) REFERENCES Orders(order_dateandtime)
-  
+-- One row per run of a maintenance.py task
+CREATE TABLE MaintenanceLog(
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task varchar(20) not null,
+    status varchar(10) not null,
+    started TIMESTAMP not null,
+    duration_ms REAL not null,
+    db_size_before INTEGER,
+    db_size_after INTEGER,
+    wal_size_before INTEGER,
+    wal_size_after INTEGER,
+    detail TEXT
 );
@@ -0,0 +1,52 @@
+-- Tables for ONE warehouse shard (see warehouses.py). Catalog tables
+-- (User, Items, ...) live in schema.sql, possibly in another file, so
+-- u_id / item_id can't be declared as foreign keys here.
+DROP TABLE IF EXISTS Stock;
+DROP TABLE IF EXISTS Orders;
+DROP TABLE IF EXISTS History;
+DROP TABLE IF EXISTS StockEvents;
+DROP TABLE IF EXISTS CheckoutLines;
+
+CREATE TABLE Stock(
+    item_id INTEGER PRIMARY KEY,
+    weight integer not null
+);
+
+CREATE TABLE Orders(
+    order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    u_id INTEGER not null,
+    item_id  integer not null,
+    quantity INTEGER not null,
+    price INTEGER not null,
+    order_dateandtime TIMESTAMP not null DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE History(
+    order_id INTEGER PRIMARY KEY,
+    u_id INTEGER not null,
+    item_id  integer not null,
+    quantity INTEGER not null,
+    price INTEGER not null,
+    dat TIMESTAMP not null DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Append-only log of this warehouse's stock/order changes; event_id is the
+-- feed sequence within the shard. weight is this warehouse's stock.
+CREATE TABLE StockEvents(
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind varchar(20) not null,
+    item_id integer not null,
+    c_id INTEGER not null,
+    weight integer not null,
+    order_id INTEGER,
+    created TIMESTAMP not null DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Stripe checkout lines booked in this warehouse, so a retried webhook
+-- delivery skips them instead of booking them again
+CREATE TABLE CheckoutLines(
+    session_id varchar(80) not null,
+    item_id integer not null,
+    order_id INTEGER not null,
+    PRIMARY KEY (session_id, item_id)
+);
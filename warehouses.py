@@ -0,0 +1,193 @@
+# ----------------------------------------------------
+# Multi-Warehouse Inventory (sharded SQLite)
+# ----------------------------------------------------
+#
+# Catalog data (admins, users, categories, items, prices) lives in the
+# catalog database. Stock and orders are per warehouse: every warehouse has
+# a shard file holding its own Stock, Orders, History and StockEvents
+# tables (shard_schema.sql), so each warehouse gets its own SQLite writer.
+#
+# WAREHOUSES lists the shards as "w_id=path" pairs, e.g.
+#     WAREHOUSES="1=database.db,2=warehouse_2.db"
+# The default keeps everything in database.db as warehouse 1.
+#
+# Shard connections ATTACH the catalog as "catalog", so a shard query can
+# join catalog.Items / catalog.User, while writes only ever touch the shard.
+#
+# Order ids are allocated from a separate range per warehouse (starting at
+# (w_id - 1) * ORDER_ID_SPAN), so the id alone says which shard has it.
+
+import concurrent.futures
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+ORDER_ID_SPAN = 10**9
+
+
+def parse_warehouses(spec):
+    shards = {}
+    for part in spec.split(","):
+        if part.strip():
+            w_id, path = part.split("=", 1)
+            shards[int(w_id)] = path.strip()
+    if not shards:
+        raise ValueError("WAREHOUSES must list at least one warehouse")
+    return shards
+
+
+def init_shard(conn, w_id, schema_path="shard_schema.sql"):
+    # Only takes effect on a new, empty file (see maintenance.py vacuum)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    with open(schema_path) as f:
+        conn.executescript(f.read())
+    if w_id > 1:
+        # Start this warehouse's order ids in its own range
+        conn.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('Orders', ?)",
+            ((w_id - 1) * ORDER_ID_SPAN,),
+        )
+
+
+class Warehouses:
+    def __init__(self, catalog_path, shards):
+        self.catalog_path = catalog_path
+        self._catalog_uri = "file:{}?mode=ro".format(
+            urllib.parse.quote(os.path.abspath(catalog_path))
+        )
+        self.shards = dict(shards)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._wal_checked = set()
+
+    @property
+    def ids(self):
+        return list(self.shards)
+
+    def connect(self, w_id):
+        # The catalog is attached read-only: shard transactions never write
+        # it, and BEGIN IMMEDIATE would otherwise also take its write lock,
+        # which deadlocks on itself when the shard is the catalog file. That
+        # case also needs WAL, or the catalog read lock would block the
+        # shard's own commit, so every shard is checked once per process.
+        conn = sqlite3.connect(self.shards[w_id], uri=True)
+        conn.row_factory = sqlite3.Row
+        if w_id not in self._wal_checked:
+            self._ensure_wal(conn, w_id)
+        conn.execute("ATTACH DATABASE ? AS catalog", (self._catalog_uri,))
+        return conn
+
+    def _ensure_wal(self, conn, w_id):
+        # init_db.py and migrate_warehouses.py create shards in WAL mode;
+        # switch any other file over (the mode is stored in the file).
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if mode != "wal":
+            try:
+                mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                mode = "{} ({})".format(mode, e)
+        if mode != "wal":
+            conn.close()
+            raise sqlite3.OperationalError(
+                "warehouse {} ({}) must use WAL journal mode, found {!r}; "
+                "run migrate_warehouses.py".format(w_id, self.shards[w_id], mode)
+            )
+        self._wal_checked.add(w_id)
+
+    def warehouse_for_order(self, order_id):
+        w_id = int(order_id) // ORDER_ID_SPAN + 1
+        return w_id if w_id in self.shards else None
+
+    def fan_out(self, fn, w_ids=None):
+        """Run fn(conn, w_id) on every shard in parallel.
+
+        Returns {w_id: result}. Each call gets its own connection.
+        """
+        w_ids = list(self.shards if w_ids is None else w_ids)
+
+        def run(w_id):
+            conn = self.connect(w_id)
+            try:
+                return fn(conn, w_id)
+            finally:
+                conn.close()
+
+        if len(w_ids) <= 1:
+            return {w_id: run(w_id) for w_id in w_ids}
+        return dict(zip(w_ids, self._executor().map(run, w_ids)))
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = make_executor(max(4, len(self.shards)))
+            return self._pool
+
+    # ---- stock ----
+
+    def stock_levels(self, item_ids=None):
+        """{item_id: {w_id: stock}} across all warehouses."""
+        if item_ids is not None:
+            item_ids = [int(i) for i in item_ids]
+            if not item_ids:
+                return {}
+
+        # Rows whose weight isn't a number (e.g. text saved by an old form)
+        # are left out rather than breaking every sum over them.
+        numeric = "typeof(weight) IN ('integer', 'real')"
+
+        def read(conn, w_id):
+            if item_ids is None:
+                return conn.execute(
+                    "SELECT item_id, weight FROM Stock WHERE " + numeric
+                ).fetchall()
+            marks = ",".join("?" * len(item_ids))
+            return conn.execute(
+                "SELECT item_id, weight FROM Stock"
+                " WHERE item_id IN ({}) AND {}".format(marks, numeric),
+                item_ids,
+            ).fetchall()
+
+        levels = {}
+        for w_id, rows in self.fan_out(read).items():
+            for item_id, weight in rows:
+                levels.setdefault(item_id, {})[w_id] = weight
+        return levels
+
+    def stock_totals(self, item_ids=None):
+        """{item_id: stock summed over warehouses}."""
+        return {
+            item_id: sum(per_warehouse.values())
+            for item_id, per_warehouse in self.stock_levels(item_ids).items()
+        }
+
+    def pick_warehouse(self, item_id, quantity):
+        """The warehouse with the most stock that can fill the whole quantity.
+
+        Returns None when no single warehouse has enough.
+        """
+        levels = self.stock_levels([item_id]).get(int(item_id), {})
+        candidates = [
+            (stock, w_id) for w_id, stock in levels.items() if stock >= quantity
+        ]
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+
+def make_executor(workers):
+    # Under gunicorn's gevent worker, threading is monkey-patched and a normal
+    # ThreadPoolExecutor would run its jobs one after another on the event
+    # loop. gevent's executor uses real OS threads (sqlite3 and hashlib
+    # release the GIL while they work), so the jobs run in parallel and the
+    # waiting greenlet yields to the others meanwhile.
+    try:
+        from gevent import monkey
+
+        if monkey.is_module_patched("threading"):
+            from gevent.threadpool import ThreadPoolExecutor
+
+            return ThreadPoolExecutor(workers)
+    except ImportError:
+        pass
+    return concurrent.futures.ThreadPoolExecutor(workers)